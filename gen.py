@@ -1,11 +1,30 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import random
 import os
-import math
+import itertools
 import re
+import string
 import threading
 import queue
+import collections
 import json  # Import JSON for config saving
+import hashlib
+import functools
+import shutil
+import errno
+import hmac
+import secrets
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit, urlunsplit
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, wait
+try:
+    import orjson # Optional: faster JSON encoding/decoding for API traffic
+except ImportError:
+    orjson = None
 import tkinter as tk
 from tkinter import ttk, scrolledtext, filedialog, messagebox
 
@@ -13,97 +32,487 @@ from tkinter import ttk, scrolledtext, filedialog, messagebox
 # 1. API & LOGIC FUNCTIONS
 # ==============================================================================
 
+# Worker threads per pipeline stage (prompt -> submit -> poll -> download).
+# Polling is where jobs spend most of their time, so it gets the most workers.
+PROMPT_WORKERS = 4
+SUBMIT_WORKERS = 4
+POLL_WORKERS = 16
+DOWNLOAD_WORKERS = 8
+# One keep-alive connection per worker so no request has to open a throwaway connection
+# when every stage is busy. The batched prompt calls run on PROMPT_WORKERS threads before
+# the stages start, so they reuse those connections.
+HTTP_POOL_SIZE = PROMPT_WORKERS + SUBMIT_WORKERS + POLL_WORKERS + DOWNLOAD_WORKERS
+
+# Freepik polling: start fast, back off with jitter, give up after a total time budget.
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 8.0
+POLL_BACKOFF = 1.6
+MAX_TOTAL_WAIT = 120
+# Task states that will never produce an image, so polling stops as soon as one shows up.
+POLL_FAILED_STATUSES = frozenset({'FAILED', 'ERROR', 'CANCELLED', 'CANCELED'})
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Local port for the optional Freepik webhook receiver (see "webhook_url" in config.json).
+DEFAULT_WEBHOOK_PORT = 8765
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+# Segments per batched DeepSeek prompt call. At ~60-100 tokens per prompt this keeps each
+# reply well under max_tokens, so long scripts never get a truncated JSON array back.
+PROMPT_BATCH_SIZE = 25
+
+# Client-side request rate caps per API host, and how often a 429'd POST is retried.
+DEEPSEEK_RPS = 5
+FREEPIK_RPS = 10
+RATE_LIMIT_RETRIES = 3
+
+# DeepSeek caches repeated prompt prefixes automatically (there is no cache_control flag),
+# so system messages keep their static instructions first and are rendered once per run.
+PROMPT_SYSTEM_TEMPLATE = (
+    "You are an expert AI prompt engineer. Your job is to convert a segment of a\n"
+    "script into a single, concise, visually descriptive image prompt.\n"
+    "Do NOT include any other text, just the final prompt.\n"
+    "The prompt MUST adhere to the following style: {style}"
+)
+BATCH_SYSTEM_TEMPLATE = (
+    "You are an expert AI prompt engineer. You will receive numbered segments of a\n"
+    "script. Convert EACH segment into a single, concise, visually descriptive image prompt.\n"
+    "Reply with a JSON object of the form {{\"prompts\": [\"...\", \"...\"]}} with one\n"
+    "prompt per segment, in the same order as the segments.\n"
+    "Every prompt MUST adhere to the following style: {style}\n"
+    "There are exactly {count} segments."
+)
+
+# On-disk caches keyed by a content hash, so repeated segments and re-runs skip the APIs.
+# Prompts live next to config.json; images live in "<output folder>/.cache".
+CACHE_DIR = ".cache"
+PROMPT_CACHE_FILE = os.path.join(CACHE_DIR, "prompts.json")
+
+_prompt_cache = {}
+_prompt_cache_lock = threading.Lock()
+
 def log_message(log_queue, message):
-    """Puts a message into the queue for the GUI to display."""
-    log_queue.put(message)
+    """Appends a message to the log buffer for the GUI to display."""
+    log_queue.append(message)
+
+def create_session():
+    """Builds one pooled HTTP session that is shared by every request in a run."""
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False # Hand the last response back so raise_for_status() reports it
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({'Accept-Encoding': 'gzip'})
+    return session
+
+def retry_after_seconds(response):
+    """Reads a Retry-After header (seconds or HTTP date). Returns None if absent/invalid."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def dumps_json(obj):
+    """Serializes obj to JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+def loads_json(data):
+    """Parses JSON bytes or text, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# Request bodies for the per-segment calls only differ in one string, so everything else is
+# serialized once per run into a (prefix, suffix) pair and the varying value goes in between.
+@functools.lru_cache(maxsize=32)
+def deepseek_body_parts(system_message):
+    """Pre-encoded DeepSeek body around the user message content."""
+    head = dumps_json({
+        "model": "deepseek-chat",
+        "stream": False,
+        "messages": [{"role": "system", "content": system_message}]
+    })
+    return head[:-2] + b',{"role":"user","content":', b'}]}'
+
+@functools.lru_cache(maxsize=32)
+def freepik_body_parts(aspect_ratio, webhook_url=None):
+    """Pre-encoded Freepik generation body around the prompt."""
+    fixed = {"aspect_ratio": aspect_ratio, "guidance_scale": 7.5}
+    if webhook_url:
+        fixed["webhook_url"] = webhook_url
+    return dumps_json(fixed)[:-1] + b',"prompt":', b'}'
+
+def splice_json(parts, value):
+    """Builds a request body from pre-encoded (prefix, suffix) parts and one JSON value."""
+    prefix, suffix = parts
+    return b''.join((prefix, dumps_json(value), suffix))
+
+def content_key(*parts):
+    """Stable hash of the given strings, used as a cache key."""
+    return hashlib.blake2b('\0'.join(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+def load_prompt_cache(log_queue):
+    """Loads prompts saved by earlier runs into the in-process prompt cache."""
+    try:
+        with open(PROMPT_CACHE_FILE, 'r') as f:
+            saved = json.load(f)
+    except (IOError, json.JSONDecodeError):
+        return
+    if not isinstance(saved, dict):
+        log_message(log_queue, f"Ignoring malformed prompt cache '{PROMPT_CACHE_FILE}'.")
+        return
+    with _prompt_cache_lock:
+        _prompt_cache.update(saved)
+
+def save_prompt_cache(log_queue):
+    """Writes the prompt cache to disk so the next run can reuse it."""
+    with _prompt_cache_lock:
+        snapshot = dict(_prompt_cache)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = PROMPT_CACHE_FILE + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, PROMPT_CACHE_FILE)
+    except IOError as e:
+        log_message(log_queue, f"Error saving prompt cache: {e}")
+
+def prompt_cache_key(style, segment):
+    """Cache key for a segment's prompt. Prompts may come from either the single or the
+    batch template, so editing either one (or the style) invalidates them."""
+    return content_key(PROMPT_SYSTEM_TEMPLATE, BATCH_SYSTEM_TEMPLATE, style.strip(), segment)
+
+def get_cached_prompt(style, segment):
+    """Returns a previously generated prompt for this style and segment, or None."""
+    with _prompt_cache_lock:
+        return _prompt_cache.get(prompt_cache_key(style, segment))
+
+def cache_prompt(style, segment, prompt):
+    """Remembers a generated prompt for this style and segment."""
+    with _prompt_cache_lock:
+        _prompt_cache[prompt_cache_key(style, segment)] = prompt
+
+def image_cache_path(output_folder, prompt, aspect_ratio):
+    """Where the image for this prompt and aspect ratio is cached."""
+    cache_key = hashlib.sha256((prompt + aspect_ratio).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(output_folder, CACHE_DIR, f"{cache_key}.png")
+
+# errno values meaning "this filesystem can't hardlink here", where copying is the fallback
+_NO_HARDLINK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK, errno.EINVAL}
+
+def link_or_copy(src, dst):
+    """Hardlinks src to dst (copying if the filesystem can't link), replacing any old dst.
+
+    The link is made under a temporary name and swapped in with os.replace, so an existing
+    dst (which may share an inode with the image cache) is never written to in place.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp_path = f"{dst}.{threading.get_ident()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path) # Leftover from an interrupted run
+    try:
+        os.link(src, tmp_path)
+    except OSError as e:
+        if e.errno not in _NO_HARDLINK_ERRNOS:
+            raise
+        shutil.copyfile(src, tmp_path) # A fresh file, so no other link sees the write
+    os.replace(tmp_path, dst)
 
+def restore_cached_image(log_queue, cache_path, file_path):
+    """Links a cached image to file_path. Returns False if there is no cached copy."""
+    if not os.path.exists(cache_path):
+        return False
+    try:
+        link_or_copy(cache_path, file_path)
+    except OSError as e:
+        log_message(log_queue, f"  > ERROR (Cache): Could not reuse cached image. {e}")
+        return False
+    log_message(log_queue, f"  > SUCCESS: Reused cached image for {file_path}")
+    return True
+
+def extract_image_url(data_obj):
+    """Returns the first generated image URL in a Freepik task object, or None."""
+    generated_images = data_obj.get('generated')
+    if generated_images and isinstance(generated_images, list):
+        return next((item for item in generated_images if isinstance(item, str) and item.startswith('http')), None)
+    return None
+
+class WebhookReceiver:
+    """Tiny HTTP server that receives Freepik task callbacks and wakes up the pollers.
+
+    Freepik POSTs the task status to the "webhook_url" given at submission time; that
+    public URL has to forward to this server's port (e.g. through a tunnel). The server
+    only listens on localhost, and callback_url carries a random per-run token that every
+    callback must echo back. Only task IDs registered with expect() are accepted.
+    """
+
+    def __init__(self, port, public_url):
+        self.token = secrets.token_urlsafe(24)
+        parts = urlsplit(public_url)
+        query = urlencode(parse_qsl(parts.query) + [('token', self.token)])
+        self.callback_url = urlunsplit(parts._replace(query=query))
+        self._urls = {}
+        self._failed = {}
+        self._events = {}
+        self._lock = threading.Lock()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                token = parse_qs(urlsplit(self.path).query).get('token', [''])[0]
+                if not hmac.compare_digest(token, receiver.token):
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+                try:
+                    length = int(self.headers['Content-Length'])
+                except (TypeError, ValueError):
+                    length = None
+                if length is None or length < 0:
+                    self.send_response(411 if 'Content-Length' not in self.headers else 400)
+                    self.end_headers()
+                    return
+                if length > WEBHOOK_MAX_BODY:
+                    self.send_response(413)
+                    self.end_headers()
+                    return
+                try:
+                    body = loads_json(self.rfile.read(length) or b'{}')
+                    data_obj = body.get('data', body)
+                    receiver.deliver(data_obj.get('task_id'), extract_image_url(data_obj),
+                                     data_obj.get('status'))
+                except (ValueError, AttributeError):
+                    pass # Ignore malformed callbacks; polling still covers the task
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass # Keep callback noise out of the console
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def expect(self, task_id):
+        """Registers a task submitted by this run so its callback will be accepted."""
+        with self._lock:
+            self._events.setdefault(task_id, threading.Event())
+
+    def deliver(self, task_id, image_url, status=None):
+        """Records a finished or failed task and wakes whoever is waiting on it."""
+        failed = str(status or '').upper() in POLL_FAILED_STATUSES
+        if not image_url and not failed:
+            return # Still in progress
+        with self._lock:
+            event = self._events.get(task_id)
+            if event is None:
+                return # Not a task this run submitted
+            if image_url:
+                self._urls[task_id] = image_url
+            else:
+                self._failed[task_id] = status
+        event.set()
+
+    def wait_for(self, task_id, timeout):
+        """Blocks up to `timeout` seconds for a callback. Returns the image URL or None."""
+        with self._lock:
+            event = self._events.get(task_id)
+        if event is None:
+            time.sleep(timeout)
+            return None
+        event.wait(timeout)
+        with self._lock:
+            return self._urls.get(task_id)
+
+    def failed_status(self, task_id):
+        """Returns the status of a task reported as failed by its callback, or None."""
+        with self._lock:
+            return self._failed.get(task_id)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class TokenBucket:
+    """Thread-safe token bucket that caps how many requests per second go to one API host."""
+
+    def __init__(self, rps):
+        self.rate = rps
+        self.tokens = rps
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.ts) * self.rate)
+                self.ts = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                sleep_for = (1 - self.tokens) / self.rate
+            time.sleep(sleep_for)
+
+deepseek_bucket = TokenBucket(DEEPSEEK_RPS)
+freepik_bucket = TokenBucket(FREEPIK_RPS)
+
+def post_rate_limited(log_queue, session, bucket, url, headers, body, timeout):
+    """POSTs under the host's rate limit, retrying when the API answers 429.
+
+    A 429 means the request was not processed, so resending it can't create a duplicate.
+    """
+    headers = {**headers, 'Content-Type': 'application/json'} # body is pre-encoded JSON
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        bucket.acquire()
+        response = session.post(url, headers=headers, data=body, timeout=timeout)
+        if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+            return response
+        sleep_for = retry_after_seconds(response)
+        if sleep_for is None:
+            sleep_for = 0.5 * 2 ** attempt
+        response.close()
+        log_message(log_queue, f"  > Rate limited (429). Retrying in {sleep_for:.1f}s...")
+        time.sleep(sleep_for)
+
+class SegmentLog:
+    """Wraps a log queue so every message is tagged with its segment number."""
+
+    def __init__(self, log_queue, segment_number):
+        self.log_queue = log_queue
+        self.prefix = f"[Segment {segment_number}]"
+
+    def append(self, message):
+        self.log_queue.append(f"{self.prefix}{message}")
+
+# Allow letters, numbers, underscore, hyphen, space; every other byte gets deleted
+_FOLDERNAME_ALLOWED = (string.ascii_lowercase + string.digits + '_- ').encode('ascii')
+_FOLDERNAME_DELETE = bytes(b for b in range(256) if b not in _FOLDERNAME_ALLOWED)
+_SPACES_RE = re.compile(r'\s+')
+
+@functools.lru_cache(maxsize=256)
 def sanitize_foldername(name):
     """Removes characters that are invalid for a folder name."""
-    name = name.lower()
-    name = re.sub(r'[^a-z0-9_\- ]', '', name) # Allow letters, numbers, underscore, hyphen, space
-    name = re.sub(r'\s+', '_', name) # Replace spaces with underscores
-    return name
+    name = name.lower().encode('ascii', 'ignore').translate(None, _FOLDERNAME_DELETE).decode('ascii')
+    return _SPACES_RE.sub('_', name) # Replace spaces with underscores
 
 def segment_script(log_queue, script_text, num_segments):
     """Splits the full script into a specified number of roughly equal chunks."""
-    words = script_text.strip().split()
+    words = script_text.split()
     if not words:
         return []
 
-    total_words = len(words)
-    words_per_segment = math.ceil(total_words / num_segments)
-    
-    segments = []
-    for i in range(num_segments):
-        start_index = i * words_per_segment
-        end_index = min((i + 1) * words_per_segment, total_words)
-        segment_words = words[start_index:end_index]
-        if segment_words:
-            segments.append(" ".join(segment_words))
+    # Spread the remainder over the first segments so no segment ends up undersized
+    step, rem = divmod(len(words), num_segments)
+    sizes = (step + 1 if i < rem else step for i in range(num_segments))
+    offsets = [0, *itertools.accumulate(sizes)]
+    segments = [" ".join(words[a:b]) for a, b in zip(offsets, offsets[1:]) if b > a]
             
     log_message(log_queue, f"Script split into {len(segments)} segments.")
     return segments
 
-def generate_prompt_from_chunk(log_queue, script_chunk, style, deepseek_key):
+def generate_prompt_from_chunk(log_queue, session, script_chunk, system_message, deepseek_key):
     """Uses DeepSeek to convert a script chunk into a descriptive image prompt."""
     log_message(log_queue, f"  > Generating prompt for chunk: '{script_chunk[:50]}...'")
     
     # --- BUG FIX: Added missing '://' ---
     url = "https://api.deepseek.com/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {deepseek_key}"
-    }
+    headers = {"Authorization": f"Bearer {deepseek_key}"}
+    body = splice_json(deepseek_body_parts(system_message), script_chunk)
     
-    system_message = f"""
-    You are an expert AI prompt engineer. Your job is to convert a segment of a
-    script into a single, concise, visually descriptive image prompt.
-    The prompt MUST adhere to the following style: {style}
-    Do NOT include any other text, just the final prompt.
+    try:
+        response = post_rate_limited(log_queue, session, deepseek_bucket, url, headers, body, timeout=30)
+        response.raise_for_status()
+        data = loads_json(response.content)
+        image_prompt = data['choices'][0]['message']['content']
+        return image_prompt.strip()
+    except requests.RequestException as e:
+        log_message(log_queue, f"  > ERROR (DeepSeek): {e}")
+        return None
+    except (KeyError, IndexError, ValueError) as e:
+        log_message(log_queue, f"  > ERROR (DeepSeek Response): Could not parse. {e}")
+        return None
+
+def generate_prompts_batch(log_queue, session, segments, style, deepseek_key):
+    """Uses one DeepSeek call to turn every script segment into an image prompt.
+
+    Returns a list with one prompt per segment, or None if the call or parsing fails.
     """
+    log_message(log_queue, f"Generating {len(segments)} prompts in a single DeepSeek request...")
+    
+    url = "https://api.deepseek.com/chat/completions"
+    headers = {"Authorization": f"Bearer {deepseek_key}"}
+    
+    system_message = BATCH_SYSTEM_TEMPLATE.format(style=style.strip(), count=len(segments))
+    
+    user_message = "".join(
+        f"\n---SEGMENT {k}---\n{segment}" for k, segment in enumerate(segments, start=1)
+    )
     
     payload = {
         "model": "deepseek-chat",
         "messages": [
             {"role": "system", "content": system_message},
-            {"role": "user", "content": script_chunk}
+            {"role": "user", "content": user_message}
         ],
+        "response_format": {"type": "json_object"},
+        "max_tokens": 8192,
         "stream": False
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = post_rate_limited(
+            log_queue, session, deepseek_bucket, url, headers, dumps_json(payload), timeout=60
+        )
         response.raise_for_status()
-        data = response.json()
-        image_prompt = data['choices'][0]['message']['content']
-        return image_prompt.strip()
+        data = loads_json(response.content)
+        prompts = loads_json(data['choices'][0]['message']['content'])['prompts']
     except requests.RequestException as e:
-        log_message(log_queue, f"  > ERROR (DeepSeek): {e}")
+        log_message(log_queue, f"  > ERROR (DeepSeek Batch): {e}")
         return None
-    except (KeyError, IndexError) as e:
-        log_message(log_queue, f"  > ERROR (DeepSeek Response): Could not parse. {e}")
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        log_message(log_queue, f"  > ERROR (DeepSeek Batch Response): Could not parse. {e}")
+        return None
+    
+    if not isinstance(prompts, list) or len(prompts) != len(segments):
+        log_message(log_queue, f"  > ERROR (DeepSeek Batch Response): Expected {len(segments)} prompts.")
         return None
+    if not all(isinstance(prompt, str) and prompt.strip() for prompt in prompts):
+        log_message(log_queue, "  > ERROR (DeepSeek Batch Response): Empty or invalid prompt in batch.")
+        return None
+    
+    return [prompt.strip() for prompt in prompts]
 
-def start_image_generation(log_queue, prompt, freepik_key, aspect_ratio):
+def start_image_generation(log_queue, session, prompt, freepik_key, aspect_ratio, webhook_url=None):
     """Calls the Freepik POST endpoint to start the image generation task."""
     log_message(log_queue, f"  > Starting image generation for prompt: '{prompt[:50]}...'")
     
     # --- BUG FIX: Added missing '://' ---
     url = "https://api.freepik.com/v1/ai/text-to-image/seedream"
-    headers = {
-        'Content-Type': 'application/json',
-        'x-freepik-api-key': freepik_key
-    }
-    payload = {
-        "prompt": prompt,
-        "aspect_ratio": aspect_ratio,
-        "guidance_scale": 7.5
-    }
+    headers = {'x-freepik-api-key': freepik_key}
+    body = splice_json(freepik_body_parts(aspect_ratio, webhook_url), prompt)
     
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=20)
+        response = post_rate_limited(log_queue, session, freepik_bucket, url, headers, body, timeout=20)
         response.raise_for_status()
-        data = response.json()
+        data = loads_json(response.content)
         
         data_obj = data.get('data', {})
         task_id = data_obj.get('task_id')
@@ -118,53 +527,179 @@ def start_image_generation(log_queue, prompt, freepik_key, aspect_ratio):
     except requests.RequestException as e:
         log_message(log_queue, f"  > ERROR (Freepik): {e}")
         return None
+    except ValueError as e:
+        log_message(log_queue, f"  > ERROR (Freepik Response): Could not parse. {e}")
+        return None
 
-def poll_for_image_url(log_queue, task_id, freepik_key):
-    """Calls the Freepik GET endpoint repeatedly until the image is ready."""
+def poll_for_image_url(log_queue, session, task_id, freepik_key, webhook=None):
+    """Calls the Freepik GET endpoint repeatedly until the image is ready.
+
+    With a WebhookReceiver, the wait between polls ends as soon as Freepik calls back,
+    and polling only backs it up in case a callback never arrives.
+    """
     log_message(log_queue, "  > Polling for image status (please wait)...")
     
     # --- BUG FIX: Added missing '://' ---
     url = f"https://api.freepik.com/v1/ai/text-to-image/seedream/{task_id}"
     headers = {'x-freepik-api-key': freepik_key}
     
-    POLL_INTERVAL = 5
-    MAX_ATTEMPTS = 20
-    
-    for attempt in range(MAX_ATTEMPTS):
+    deadline = time.monotonic() + MAX_TOTAL_WAIT
+    delay = POLL_MAX_DELAY if webhook else POLL_INITIAL_DELAY
+    sleep_for = delay + random.uniform(0, delay * 0.5)
+    attempt = 0
+
+    while time.monotonic() + sleep_for < deadline:
+        # Wait *before* checking
+        if webhook:
+            image_url = webhook.wait_for(task_id, sleep_for)
+            if image_url:
+                log_message(log_queue, "  > Image generation successful! (webhook)")
+                return image_url
+            status = webhook.failed_status(task_id)
+            if status:
+                log_message(log_queue, f"  > ERROR (Freepik): Task {status} (webhook). Giving up.")
+                return None
+        else:
+            time.sleep(sleep_for)
+        attempt += 1
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
+        sleep_for = delay + random.uniform(0, delay * 0.5) # Jitter keeps parallel jobs out of phase
         try:
-            time.sleep(POLL_INTERVAL) # Wait *before* checking
-            response = requests.get(url, headers=headers, timeout=20)
+            freepik_bucket.acquire()
+            response = session.get(url, headers=headers, timeout=20)
+            if response.status_code == 429:
+                retry_after = retry_after_seconds(response)
+                if retry_after is not None:
+                    sleep_for = retry_after
+                log_message(log_queue, f"  > Rate limited by Freepik. Waiting {sleep_for:.1f}s...")
+                continue
             response.raise_for_status()
-            data = response.json()
+            data = loads_json(response.content)
             
             data_obj = data.get('data', {})
             status = data_obj.get('status')
-            generated_images = data_obj.get('generated')
+            image_url = extract_image_url(data_obj)
             
-            if generated_images and isinstance(generated_images, list) and len(generated_images) > 0:
-                image_url = next((item for item in generated_images if isinstance(item, str) and item.startswith('http')), None)
-                if image_url:
-                    log_message(log_queue, "  > Image generation successful!")
-                    return image_url
+            if image_url:
+                log_message(log_queue, "  > Image generation successful!")
+                return image_url
+
+            if str(status or '').upper() in POLL_FAILED_STATUSES:
+                log_message(log_queue, f"  > ERROR (Freepik): Task {status}. Giving up.")
+                return None
             
-            log_message(log_queue, f"  > Status (Attempt {attempt+1}/{MAX_ATTEMPTS}): {status}. Waiting...")
-        except requests.RequestException as e:
+            log_message(log_queue, f"  > Status (Attempt {attempt}): {status}. Waiting {sleep_for:.1f}s...")
+        except (requests.RequestException, ValueError) as e:
             log_message(log_queue, f"  > ERROR (Freepik Poll): {e}. Retrying...")
             
-    log_message(log_queue, "  > ERROR: Max polling attempts reached. Job failed or timed out.")
+    log_message(log_queue, f"  > ERROR: No image after {MAX_TOTAL_WAIT}s of polling. Job failed or timed out.")
     return None
 
-def download_and_save_image(log_queue, image_url, file_path):
-    """Downloads the final image from the URL and saves it to the disk."""
+def download_and_save_image(log_queue, session, image_url, file_path):
+    """Streams the final image from the URL to disk without buffering it in memory."""
+    response = None
+    # Write beside the target and swap it in, so an existing file (possibly hardlinked
+    # to the image cache) is replaced rather than truncated in place
+    part_path = file_path + ".part"
     try:
-        response = requests.get(image_url, timeout=30)
+        response = session.get(image_url, timeout=30, stream=True)
         response.raise_for_status()
         
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
+        with open(part_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(part_path, file_path)
         log_message(log_queue, f"  > SUCCESS: Image saved to {file_path}")
+        return True
     except requests.RequestException as e:
         log_message(log_queue, f"  > ERROR (Download): Could not download image. {e}")
+        if os.path.exists(part_path):
+            os.remove(part_path) # Don't leave a truncated image behind
+        return False
+    finally:
+        if response is not None:
+            response.close()
+
+def prompt_stage(job, session, system_message, style, deepseek_key):
+    """Pipeline stage: makes sure the job has an image prompt."""
+    log_message(job['log'], f" --- Processing segment: '{job['segment'][:50]}...' ---")
+
+    # Only call DeepSeek here if the batch call did not provide a prompt
+    if not job['prompt']:
+        job['prompt'] = generate_prompt_from_chunk(job['log'], session, job['segment'], system_message, deepseek_key)
+        if job['prompt']:
+            cache_prompt(style, job['segment'], job['prompt'])
+
+    if not job['prompt']:
+        log_message(job['log'], "  > Skipping segment due to prompt generation error.")
+        return None
+    log_message(job['log'], f"  > Generated Prompt: {job['prompt']}")
+    return job
+
+def submit_stage(job, session, freepik_key, aspect_ratio, output_folder, webhook=None):
+    """Pipeline stage: starts the Freepik generation task for the job's prompt.
+
+    If this prompt and aspect ratio were already generated, the cached image is linked
+    into place instead and the job skips the remaining network stages.
+    """
+    job['cache_path'] = image_cache_path(output_folder, job['prompt'], aspect_ratio)
+    if restore_cached_image(job['log'], job['cache_path'], job['file_path']):
+        job['cached'] = True
+        return job
+
+    job['task_id'] = start_image_generation(
+        job['log'], session, job['prompt'], freepik_key, aspect_ratio,
+        webhook.callback_url if webhook else None
+    )
+
+    if not job['task_id']:
+        log_message(job['log'], "  > Skipping segment due to image generation start error.")
+        return None
+    if webhook:
+        webhook.expect(job['task_id'])
+    return job
+
+def poll_stage(job, session, freepik_key, webhook=None):
+    """Pipeline stage: waits for the Freepik task to produce an image URL."""
+    if job.get('cached'):
+        return job
+    job['image_url'] = poll_for_image_url(job['log'], session, job['task_id'], freepik_key, webhook)
+
+    if not job['image_url']:
+        log_message(job['log'], "  > Skipping segment due to image polling error.")
+        return None
+    log_message(job['log'], f"  > Image URL found: {job['image_url']}")
+    return job
+
+def download_stage(job, session):
+    """Pipeline stage: saves the finished image to the job's file path and the image cache."""
+    if job.get('cached'):
+        return job
+    if not download_and_save_image(job['log'], session, job['image_url'], job['file_path']):
+        return None
+    try:
+        link_or_copy(job['file_path'], job['cache_path'])
+    except OSError as e:
+        log_message(job['log'], f"  > WARNING: Could not cache image. {e}")
+    return job
+
+def stage_worker(in_q, out_q, stage):
+    """Runs `stage` on jobs from in_q and forwards the ones that succeed to out_q.
+
+    A None sentinel on in_q stops the worker; it is put back so sibling workers stop too.
+    """
+    while True:
+        job = in_q.get()
+        if job is None:
+            in_q.put(None)
+            return
+        try:
+            result = stage(job)
+        except Exception as e:
+            log_message(job['log'], f"  > ERROR (Segment): {e}")
+            result = None
+        if result is not None:
+            out_q.put(result)
 
 # ==============================================================================
 # 2. MAIN PIPELINE (Unchanged)
@@ -184,9 +719,12 @@ def main_pipeline(log_queue, config):
     style_guide = config["style_guide"]
     output_folder = config["output_folder"]
     aspect_ratio = config["aspect_ratio"] 
+    system_message = PROMPT_SYSTEM_TEMPLATE.format(style=style_guide.strip())
+    webhook_url = config.get("webhook_url")
+    webhook_port = config.get("webhook_port") or DEFAULT_WEBHOOK_PORT
 
     os.makedirs(output_folder, exist_ok=True)
-    log_message(log_queue, f"Images will be saved as 1.png, 2.png, etc. in '{output_folder}'.")
+    log_message(log_queue, f"Images will be saved as 1.png, 2.png, etc. (one per segment) in '{output_folder}'.")
 
     # 1. Segment Script
     script_segments = segment_script(log_queue, full_script, num_images)
@@ -195,43 +733,120 @@ def main_pipeline(log_queue, config):
         log_message(log_queue, "Error: Script is empty or could not be segmented. Exiting.")
         return
         
-    image_counter = 1
-    
-    for i, segment in enumerate(script_segments):
-        log_message(log_queue, f"\n--- Processing Segment {i+1} of {len(script_segments)} ---")
-        
-        # 2. Generate Prompt
-        image_prompt = generate_prompt_from_chunk(log_queue, segment, style_guide, deepseek_key)
-        
-        if not image_prompt:
-            log_message(log_queue, "  > Skipping segment due to prompt generation error.")
-            continue
-        log_message(log_queue, f"  > Generated Prompt: {image_prompt}")
-            
-        # 3. Start Image Generation
-        task_id = start_image_generation(log_queue, image_prompt, freepik_key, aspect_ratio)
-        
-        if not task_id:
-            log_message(log_queue, "  > Skipping segment due to image generation start error.")
-            continue
-            
-        # 4. Poll for URL
-        image_url = poll_for_image_url(log_queue, task_id, freepik_key)
-        
-        if not image_url:
-            log_message(log_queue, "  > Skipping segment due to image polling error.")
-            continue
-        log_message(log_queue, f"  > Image URL found: {image_url}")
-        
-        # 5. Download and Save
-        file_name = f"{image_counter}.png"
-        file_path = os.path.join(output_folder, file_name)
-        
-        download_and_save_image(log_queue, image_url, file_path)
-        image_counter += 1
-        
+    total = len(script_segments)
+    log_message(log_queue, f"Processing {total} segments (up to {POLL_WORKERS} images in flight)...")
+
+    webhook = None
+    if webhook_url:
+        try:
+            webhook = WebhookReceiver(int(webhook_port), webhook_url)
+            log_message(log_queue, f"Listening for Freepik callbacks on localhost:{webhook_port} ({webhook_url}).")
+        except (OSError, ValueError) as e:
+            log_message(log_queue, f"Could not start webhook receiver ({e}). Falling back to polling only.")
+
+    session = create_session()
+    try:
+        # Only queue the first of any identical segments
+        load_prompt_cache(log_queue)
+        os.makedirs(os.path.join(output_folder, CACHE_DIR), exist_ok=True)
+        jobs = []
+        duplicates = []
+        first_jobs = {}
+        for i, segment in enumerate(script_segments):
+            segment_log = SegmentLog(log_queue, i + 1)
+            file_path = os.path.join(output_folder, f"{i + 1}.png")
+            if segment in first_jobs:
+                duplicates.append((segment_log, first_jobs[segment], file_path))
+            else:
+                first_jobs[segment] = {'log': segment_log, 'segment': segment, 'file_path': file_path}
+                jobs.append(first_jobs[segment])
+        if duplicates:
+            log_message(log_queue, f"Skipping {len(duplicates)} repeated segments.")
+
+        # 2. Generate all uncached prompts up front, PROMPT_BATCH_SIZE segments per request
+        missing = list(dict.fromkeys(
+            job['segment'] for job in jobs if get_cached_prompt(style_guide, job['segment']) is None
+        ))
+        if len(missing) < len(jobs):
+            log_message(log_queue, f"Reusing cached prompts for {len(jobs) - len(missing)} segments.")
+        batches = [missing[i:i + PROMPT_BATCH_SIZE] for i in range(0, len(missing), PROMPT_BATCH_SIZE)]
+        if batches:
+            with ThreadPoolExecutor(max_workers=PROMPT_WORKERS) as executor:
+                results = executor.map(
+                    lambda batch: generate_prompts_batch(log_queue, session, batch, style_guide, deepseek_key),
+                    batches
+                )
+                for batch, prompts in zip(batches, results):
+                    if prompts is None:
+                        log_message(log_queue, f"Batch prompt generation failed for {len(batch)} segments. "
+                                               "Falling back to one request per segment.")
+                        continue
+                    for segment, prompt in zip(batch, prompts):
+                        cache_prompt(style_guide, segment, prompt)
+        for job in jobs:
+            job['prompt'] = get_cached_prompt(style_guide, job['segment'])
+
+        # 3-5. Prompt -> submit -> poll -> download, each stage fed by the previous one's queue
+        segment_q, prompt_q, task_q, url_q, done_q = (queue.Queue() for _ in range(5))
+        stages = [
+            (functools.partial(prompt_stage, session=session, system_message=system_message, style=style_guide,
+                               deepseek_key=deepseek_key),
+             PROMPT_WORKERS, segment_q, prompt_q),
+            (functools.partial(submit_stage, session=session, freepik_key=freepik_key, aspect_ratio=aspect_ratio,
+                               output_folder=output_folder, webhook=webhook),
+             SUBMIT_WORKERS, prompt_q, task_q),
+            (functools.partial(poll_stage, session=session, freepik_key=freepik_key, webhook=webhook),
+             POLL_WORKERS, task_q, url_q),
+            (functools.partial(download_stage, session=session),
+             DOWNLOAD_WORKERS, url_q, done_q),
+        ]
+
+        executors = []
+        try:
+            running = []
+            for stage, workers, in_q, out_q in stages:
+                executor = ThreadPoolExecutor(max_workers=workers)
+                executors.append(executor)
+                running.append([executor.submit(stage_worker, in_q, out_q, stage) for _ in range(workers)])
+
+            for job in jobs:
+                segment_q.put(job)
+            segment_q.put(None)
+
+            # Once a stage has drained, tell the next stage that no more jobs are coming
+            for (_, _, _, out_q), futures in zip(stages, running):
+                wait(futures)
+                out_q.put(None)
+        finally:
+            for _, _, in_q, _ in stages:
+                in_q.put(None) # Unblocks any workers left waiting if we bailed out early
+            for executor in executors:
+                executor.shutdown(wait=True)
+
+        finished = [id(job) for job in done_q.queue if job is not None]
+        generated = len(finished)
+
+        # Repeated segments get a link to the image made for their first occurrence
+        for segment_log, first_job, file_path in duplicates:
+            if id(first_job) not in finished:
+                log_message(segment_log, "  > Skipping repeated segment because its first occurrence failed.")
+                continue
+            # The cache copy can be missing if caching failed; the first numbered image is the backup
+            source = first_job['cache_path']
+            if not os.path.exists(source):
+                source = first_job['file_path']
+            if restore_cached_image(segment_log, source, file_path):
+                generated += 1
+            else:
+                log_message(segment_log, f"  > ERROR (Cache): No image to reuse from {first_job['file_path']}.")
+    finally:
+        save_prompt_cache(log_queue)
+        session.close()
+        if webhook:
+            webhook.close()
+
     log_message(log_queue, "\n--- Pipeline Complete ---")
-    log_message(log_queue, f"Successfully generated {image_counter - 1} images.")
+    log_message(log_queue, f"Successfully generated {generated} of {total} images.")
 
 # ==============================================================================
 # 3. TKINTER GUI APPLICATION (New 2-Column "Best" Design)
@@ -241,6 +856,12 @@ class App(tk.Tk):
     
     CONFIG_FILE = "config.json"
     
+    # Log console refresh: how often to drain the queue, and the most lines per refresh
+    LOG_POLL_MS = 50
+    LOG_BATCH_LIMIT = 500
+    # Oldest lines are dropped past this many, so a stalled GUI can't grow memory forever
+    LOG_QUEUE_MAXLEN = 10000
+    
     BG_COLOR = "#2B2B2B"
     FG_COLOR = "#E0E0E0"
     WIDGET_BG = "#3C3F41"
@@ -419,8 +1040,11 @@ class App(tk.Tk):
         self.log_text.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
         
         # --- Threading & Queue Setup ---
-        self.log_queue = queue.Queue()
+        # deque.append/popleft are atomic in CPython, so workers log without taking a lock
+        self.log_queue = collections.deque(maxlen=self.LOG_QUEUE_MAXLEN)
         self.is_running = False
+        self.webhook_url = None
+        self.webhook_port = None
         
         self.load_config()
         self.process_log_queue()
@@ -439,11 +1063,13 @@ class App(tk.Tk):
         )
 
     def load_config(self):
-        """Loads API keys from config.json if it exists."""
+        """Loads API keys (and optional webhook settings) from config.json if it exists."""
         try:
             if os.path.exists(self.CONFIG_FILE):
                 with open(self.CONFIG_FILE, 'r') as f:
                     config = json.load(f)
+                    self.webhook_url = config.get("webhook_url")
+                    self.webhook_port = config.get("webhook_port")
                     if config.get("freepik_key"):
                         self.freepik_key_entry.delete(0, tk.END)
                         self.freepik_key_entry.insert(0, config["freepik_key"])
@@ -454,11 +1080,15 @@ class App(tk.Tk):
             print(f"Error loading config: {e}")
 
     def save_config(self):
-        """Saves the current API keys to config.json."""
+        """Saves the current API keys (and any webhook settings) to config.json."""
         config = {
             "freepik_key": self.freepik_key_entry.get(),
             "deepseek_key": self.deepseek_key_entry.get()
         }
+        if self.webhook_url:
+            config["webhook_url"] = self.webhook_url
+        if self.webhook_port:
+            config["webhook_port"] = self.webhook_port
         try:
             with open(self.CONFIG_FILE, 'w') as f:
                 json.dump(config, f, indent=4)
@@ -492,7 +1122,9 @@ class App(tk.Tk):
             "full_script": self.full_script_text.get("1.0", tk.END),
             "style_guide": self.style_guide_text.get("1.0", tk.END),
             "output_folder": self.output_folder_entry.get(),
-            "aspect_ratio": self.aspect_ratio_combo.get()
+            "aspect_ratio": self.aspect_ratio_combo.get(),
+            "webhook_url": self.webhook_url,
+            "webhook_port": self.webhook_port
         }
         
         if not config["freepik_key"] or not config["deepseek_key"]:
@@ -527,29 +1159,33 @@ class App(tk.Tk):
         try:
             main_pipeline(self.log_queue, config)
         except Exception as e:
-            self.log_queue.put(f"\n--- A CRITICAL ERROR OCCURRED ---\n{e}")
+            self.log_queue.append(f"\n--- A CRITICAL ERROR OCCURRED ---\n{e}")
         finally:
-            self.log_queue.put("---PIPELINE_COMPLETE---")
+            self.log_queue.append("---PIPELINE_COMPLETE---")
 
     def process_log_queue(self):
-        """Checks the log queue for messages and updates the GUI."""
+        """Drains the log queue and shows all new messages in a single Tk update."""
+        messages = []
+        pipeline_done = False
         try:
-            while True:
-                message = self.log_queue.get_nowait()
+            while self.log_queue and len(messages) < self.LOG_BATCH_LIMIT:
+                message = self.log_queue.popleft()
                 
                 if message == "---PIPELINE_COMPLETE---":
-                    self.start_button.config(text="Start Generation", state="normal")
-                    self.is_running = False
+                    pipeline_done = True
                 else:
-                    self.log_text.configure(state="normal")
-                    self.log_text.insert(tk.END, message + "\n")
-                    self.log_text.see(tk.END) # Auto-scroll
-                    self.log_text.configure(state="disabled")
+                    messages.append(message)
                     
-        except queue.Empty:
-            pass # No messages, just check again later
         finally:
-            self.after(100, self.process_log_queue)
+            if messages:
+                self.log_text.configure(state="normal")
+                self.log_text.insert(tk.END, "\n".join(messages) + "\n")
+                self.log_text.see(tk.END) # Auto-scroll
+                self.log_text.configure(state="disabled")
+            if pipeline_done:
+                self.start_button.config(text="Start Generation", state="normal")
+                self.is_running = False
+            self.after(self.LOG_POLL_MS, self.process_log_queue)
 
 # ==============================================================================
 # 4. RUN THE APPLICATION